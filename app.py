@@ -1,89 +1,437 @@
 import streamlit as st
-import openai
-from typing import List, Dict, Any
-from dataclasses import dataclass
-import json
-
-@dataclass
-class MusicPreferences:
-    age: int
-    mood: str
-    favorite_genres: List[str]
-    hidden_gems_ratio: int  # Percentage of hidden gems (0-100)
-
-@dataclass
-class Song:
-    title: str
-    artist: str
-    genre: str
-    popularity: float
+from openai import AsyncOpenAI
+from blake3 import blake3
+from diskcache import Cache
+from typing import List, Dict, Any, Optional, Tuple, Set, AsyncIterator, Awaitable, Iterator, TypeVar
+from heapq import nlargest
+from operator import attrgetter
+import asyncio
+import httpx
+import msgspec
+import os
+import pandas as pd
+import tempfile
+import threading
+
+from batch import submit_batch, collect_batch
+from playlist import (
+    MusicPreferences, Song, SONG_FIELDS,
+    PLAYLIST_DECODER, MULTI_PLAYLIST_DECODER, SONG_DECODER, SONG_LIST_DECODER,
+    MOOD_OPTIONS, AGE_LABELS, MAX_AGE, AGE_LUT, GENRE_BY_AGE, PLAYLIST_SIZE,
+    SYSTEM_MESSAGE, PROMPT_TEMPLATE, playlist_schema, multi_playlist_schema, SONG_OBJECT_RE
+)
+
+MODEL = "gpt-4o-mini"
+# Raced against each other when the user opts into higher quality
+RACE_MODELS = (MODEL, "gpt-4o")
+
+PlaylistKey = Tuple[str, str, Tuple[str, ...], int]
+
+# About 40 tokens per song object plus headroom, and 64 for the JSON envelope
+TOKENS_PER_SONG = 48
+
+DISK_CACHE_TTL = 24 * 60 * 60
+
+# Seconds; generous enough for a full non-streamed playlist
+REQUEST_TIMEOUT = 30.0
+
+# Requests arriving within the window share one completion
+COALESCE_WINDOW = 0.1
+COALESCE_MAX_REQUESTS = 10
+
+T = TypeVar("T")
+
+def _max_tokens(size: int) -> int:
+    return size * TOKENS_PER_SONG + 64
+
+@st.cache_resource
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    # A single long-lived loop, so pooled connections stay usable across reruns
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def _run(coro: Awaitable[T]) -> T:
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+def _iter_async(items: AsyncIterator[T]) -> Iterator[T]:
+    # Pull items back onto the calling thread so they can be rendered
+    while True:
+        try:
+            yield _run(items.__anext__())
+        except StopAsyncIteration:
+            return
+
+@st.cache_resource
+def _get_openai() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        max_retries=2,
+        timeout=REQUEST_TIMEOUT,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60)
+        )
+    )
+
+@st.cache_resource
+def _get_disk_cache() -> Cache:
+    return Cache(os.path.join(tempfile.gettempdir(), "aimusic_cache"), size_limit=256 << 20)
+
+def _cache_key(request: Dict[str, Any]) -> str:
+    # Disk cache shared across processes and restarts, keyed on the full request
+    return blake3(msgspec.json.encode(request, order="sorted")).hexdigest()
+
+def _to_columns(songs: List[Song]) -> Dict[str, List[Any]]:
+    # Struct-of-arrays: a few flat lists pickle into the cache faster than
+    # a dict per song, and become DataFrame columns without per-row work
+    return {field: [getattr(song, field) for song in songs] for field in SONG_FIELDS}
+
+def _playlist_frame(columns: Dict[str, List[Any]]) -> pd.DataFrame:
+    # Indexed from 1 so the index doubles as the track number
+    return pd.DataFrame(columns, index=range(1, len(columns["title"]) + 1))
+
+def _rank_playlist(songs: List[Song]) -> List[Song]:
+    # Per-genre playlists can overlap, so drop repeats before ranking
+    unique = {(song.title.casefold(), song.artist.casefold()): song for song in songs}
+    # Most popular first, capped in case the model overshoots
+    return nlargest(PLAYLIST_SIZE, unique.values(), key=attrgetter("popularity"))
+
+async def _merge_streams(streams: List[AsyncIterator[T]]) -> AsyncIterator[T]:
+    # Yields items from all streams in arrival order
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def drain(stream: AsyncIterator[T]):
+        try:
+            async for item in stream:
+                queue.put_nowait(item)
+            queue.put_nowait(done)
+        except Exception as e:
+            queue.put_nowait(e)
+
+    tasks = [asyncio.create_task(drain(stream)) for stream in streams]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+class PlaylistCoalescer:
+    def __init__(self, agent: "MusicAgent"):
+        self.agent = agent
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    def _spawn(self, coro: Awaitable[None]):
+        # The loop only keeps weak references to tasks
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def submit(self, key: PlaylistKey) -> List[Song]:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self._spawn(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((key, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + COALESCE_WINDOW
+            while len(pending) < COALESCE_MAX_REQUESTS:
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            self._spawn(self._dispatch(pending))
+
+    async def _dispatch(self, pending: List[Tuple[PlaylistKey, asyncio.Future]]):
+        try:
+            playlists = await self.agent.fetch_playlists([key for key, _ in pending])
+        except Exception as e:
+            playlists = [e] * len(pending)
+        for (_, future), playlist in zip(pending, playlists):
+            # The caller may have given up already
+            if future.done():
+                continue
+            if isinstance(playlist, Exception):
+                future.set_exception(playlist)
+            elif playlist is None:
+                future.set_exception(RuntimeError("No playlist returned for this request"))
+            else:
+                future.set_result(playlist)
 
 class MusicAgent:
     def __init__(self):
-        openai.api_key = st.secrets["OPENAI_API_KEY"]
-        
-        self.mood_options = [
-            "Happy", "Energetic", "Relaxed", "Melancholic",
-            "Focused", "Romantic", "Party", "Chill"
-        ]
-        
-        self.genre_by_age = {
-            "13-17": ["Pop", "Hip Hop", "K-pop", "Alternative", "Indie"],
-            "18-24": ["Pop", "Hip Hop", "R&B", "Alternative", "Electronic"],
-            "25-34": ["Pop", "Rock", "Hip Hop", "R&B", "Electronic"],
-            "35-44": ["Rock", "Pop", "Alternative", "Country", "Jazz"],
-            "45+": ["Classic Rock", "Jazz", "Classical", "Country", "Folk"]
+        self.client = _get_openai()
+        self.disk_cache = _get_disk_cache()
+        # Merge concurrent users' requests into one completion to save RPM budget
+        self.coalesce = st.secrets.get("COALESCE_REQUESTS", False)
+        self.coalescer = PlaylistCoalescer(self)
+
+    @staticmethod
+    def get_age_group(age: int) -> str:
+        return AGE_LABELS[AGE_LUT[min(max(age, 0), MAX_AGE)]]
+
+    def _request_key(self, preferences: MusicPreferences) -> PlaylistKey:
+        # Genre order doesn't change the playlist, so normalize it for caching
+        return (
+            self.get_age_group(preferences.age),
+            preferences.mood,
+            tuple(sorted(preferences.favorite_genres)),
+            preferences.hidden_gems_ratio
+        )
+
+    def _format_prompt(self, age_group: str, mood: str, genres: Tuple[str, ...],
+                       hidden_gems_ratio: int, size: int = PLAYLIST_SIZE) -> str:
+        return PROMPT_TEMPLATE.format(
+            size=size,
+            age_group=age_group,
+            mood=mood,
+            genres=", ".join(genres),
+            hidden_gems_ratio=hidden_gems_ratio,
+            popular_ratio=100 - hidden_gems_ratio
+        )
+
+    def _build_request(self, age_group: str, mood: str, genres: Tuple[str, ...],
+                       hidden_gems_ratio: int, model: str = MODEL,
+                       size: int = PLAYLIST_SIZE) -> Dict[str, Any]:
+        return {
+            "model": model,
+            "messages": [
+                SYSTEM_MESSAGE,
+                {"role": "user", "content": self._format_prompt(age_group, mood, genres, hidden_gems_ratio, size)}
+            ],
+            "max_tokens": _max_tokens(size),
+            "temperature": 0.7,
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "playlist", "schema": playlist_schema(size), "strict": True}
+            }
         }
 
-    def get_age_group(self, age: int) -> str:
-        if age < 18: return "13-17"
-        elif age < 25: return "18-24"
-        elif age < 35: return "25-34"
-        elif age < 45: return "35-44"
-        else: return "45+"
+    def _build_coalesced_request(self, keys: List[PlaylistKey]) -> Dict[str, Any]:
+        prompt = "\n\n".join(
+            f"### User {i} ###\n{self._format_prompt(*key)}" for i, key in enumerate(keys, 1)
+        )
+        return {
+            "model": MODEL,
+            "messages": [
+                SYSTEM_MESSAGE,
+                {"role": "user", "content": (
+                    "Create a separate playlist for each user, in the order given, and set "
+                    f"\"user\" to the user's number.\n\n{prompt}"
+                )}
+            ],
+            "max_tokens": _max_tokens(PLAYLIST_SIZE) * len(keys),
+            "temperature": 0.7,
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "playlists", "schema": multi_playlist_schema(len(keys)), "strict": True}
+            }
+        }
 
-    def generate_playlist(self, preferences: MusicPreferences) -> List[Song]:
-        try:
-            prompt = f"""Generate a playlist of 25 songs for:
-            Age: {preferences.age}, Mood: {preferences.mood}
-            Genres: {', '.join(preferences.favorite_genres)}
-            
-            Distribution: {preferences.hidden_gems_ratio}% hidden gems (popularity 0.1-0.4) 
-            and {100 - preferences.hidden_gems_ratio}% popular songs (popularity 0.7-1.0)
-            
-            Return as JSON array: {{"songs": [
-                {{"title": "name", "artist": "artist", "genre": "genre", "popularity": 0.9}}
-            ]}}"""
-
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.7
+    async def _cache_get(self, request: Dict[str, Any]) -> Optional[List[Song]]:
+        # SQLite I/O would otherwise block every session's streams on the shared loop
+        cached = await asyncio.to_thread(self.disk_cache.get, _cache_key(request))
+        return None if cached is None else SONG_LIST_DECODER.decode(cached)
+
+    async def _cache_set(self, request: Dict[str, Any], songs: List[Song]):
+        await asyncio.to_thread(
+            self.disk_cache.set, _cache_key(request), msgspec.json.encode(songs), expire=DISK_CACHE_TTL
+        )
+
+    def _parse_playlist_response(self, content: str) -> List[Song]:
+        # Structured outputs guarantee the schema, so no defaults are needed
+        return _rank_playlist(PLAYLIST_DECODER.decode(content).songs)
+
+    async def stream_playlist(self, age_group: str, mood: str, genres: Tuple[str, ...],
+                              hidden_gems_ratio: int) -> AsyncIterator[Song]:
+        # One smaller playlist per genre, generated concurrently. Sizes add up to
+        # exactly PLAYLIST_SIZE so ranking never trims the hidden gems. Each is
+        # cached per genre and size, so a genre's result is only reused when it
+        # gets the same share again: adding or removing a genre changes every
+        # size, and a swap can move the remainder songs to other genres.
+        base, extra = divmod(PLAYLIST_SIZE, len(genres))
+        streams = [
+            self._stream_request(
+                self._build_request(age_group, mood, (genre,), hidden_gems_ratio, size=base + (i < extra))
             )
-            
-            # Parse response
-            content = response.choices[0].message.content
-            data = json.loads(content)
-            songs = []
-            
-            for song_data in data.get('songs', []):
-                songs.append(Song(
-                    title=song_data.get('title', ''),
-                    artist=song_data.get('artist', ''),
-                    genre=song_data.get('genre', ''),
-                    popularity=float(song_data.get('popularity', 0.5))
-                ))
-            
-            return sorted(songs, key=lambda x: x.popularity, reverse=True)
+            for i, genre in enumerate(genres)
+        ]
+        async for song in _merge_streams(streams):
+            yield song
+
+    async def _stream_request(self, request: Dict[str, Any]) -> AsyncIterator[Song]:
+        cached = await self._cache_get(request)
+        if cached is not None:
+            for song in cached:
+                yield song
+            return
+
+        stream = await self.client.chat.completions.create(**request, stream=True)
+        content = bytearray()
+        parsed = 0
+        emitted = 0
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if not chunk.choices[0].delta.content:
+                continue
+            content += chunk.choices[0].delta.content.encode()
+            # Emit each song as soon as its closing brace arrives
+            for match in SONG_OBJECT_RE.finditer(content, parsed):
+                parsed = match.end()
+                emitted += 1
+                yield SONG_DECODER.decode(match.group())
+
+        # Truncated or filtered completions fail like the other paths, so a
+        # partial playlist is never cached
+        if finish_reason != "stop":
+            raise RuntimeError(f"Playlist generation stopped early ({finish_reason})")
+        # The full parse is authoritative; emit anything the scan missed
+        songs = PLAYLIST_DECODER.decode(content).songs
+        for song in songs[emitted:]:
+            yield song
+        await self._cache_set(request, songs)
+
+    async def race_playlist(self, age_group: str, mood: str, genres: Tuple[str, ...],
+                            hidden_gems_ratio: int) -> List[Song]:
+        requests = [
+            self._build_request(age_group, mood, genres, hidden_gems_ratio, model=model)
+            for model in RACE_MODELS
+        ]
+        for request in requests:
+            cached = await self._cache_get(request)
+            if cached is not None:
+                return _rank_playlist(cached)
+
+        tasks = [asyncio.create_task(self._complete(request)) for request in requests]
+        try:
+            # First response that parses wins; a failed one falls back to the other
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return _rank_playlist(await next_done)
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _complete(self, request: Dict[str, Any]) -> List[Song]:
+        response = await self.client.chat.completions.create(**request)
+        songs = PLAYLIST_DECODER.decode(response.choices[0].message.content).songs
+        await self._cache_set(request, songs)
+        return songs
+
+    async def coalesced_playlist(self, key: PlaylistKey) -> List[Song]:
+        # Shares the whole-playlist entry with the race path and single-genre
+        # streams; multi-genre streams cache each genre separately instead
+        request = self._build_request(*key)
+        cached = await self._cache_get(request)
+        if cached is not None:
+            return _rank_playlist(cached)
+        songs = await self.coalescer.submit(key)
+        await self._cache_set(request, songs)
+        return songs
+
+    async def fetch_playlists(self, keys: List[PlaylistKey]) -> List[Optional[List[Song]]]:
+        # A coalesced completion is several playlists long, so give it more time
+        response = await self.client.chat.completions.create(
+            **self._build_coalesced_request(keys),
+            timeout=REQUEST_TIMEOUT * len(keys)
+        )
+        # The schema asks for exactly one block per user in prompt order
+        playlists: List[Optional[List[Song]]] = [None] * len(keys)
+        decoded = MULTI_PLAYLIST_DECODER.decode(response.choices[0].message.content).playlists
+        for i, playlist in enumerate(decoded[:len(keys)]):
+            playlists[i] = _rank_playlist(playlist.songs)
+        return playlists
+
+    def generate_playlist(self, preferences: MusicPreferences, race: bool = False) -> pd.DataFrame:
+        try:
+            columns = _cached_generate(self, *self._request_key(preferences), race)
         except Exception as e:
             st.error(f"Error generating playlist: {str(e)}")
-            return []
+            columns = _to_columns([])
+        return _playlist_frame(columns)
+
+    async def generate_playlist_batch(self, preferences_list: List[MusicPreferences]) -> str:
+        return await submit_batch(
+            self.client,
+            [self._build_request(*self._request_key(preferences)) for preferences in preferences_list]
+        )
+
+    async def collect_playlist_batch(self, batch_id: str) -> Optional[List[pd.DataFrame]]:
+        contents = await collect_batch(self.client, batch_id)
+        if contents is None:
+            return None
+        return [
+            _playlist_frame(_to_columns(self._parse_playlist_response(content) if content else []))
+            for content in contents
+        ]
+
+@st.cache_resource
+def _get_agent() -> MusicAgent:
+    return MusicAgent()
+
+# Failed generations raise out of here, so only successful playlists are cached.
+# The preview is created inside the cached function so cache hits can replay it.
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _cached_generate(_agent: MusicAgent, age_group: str, mood: str, genres: Tuple[str, ...],
+                     hidden_gems_ratio: int, race: bool) -> Dict[str, List[Any]]:
+    if race:
+        songs = _run(_agent.race_playlist(age_group, mood, genres, hidden_gems_ratio))
+        return _to_columns(songs)
+    if _agent.coalesce:
+        songs = _run(_agent.coalesced_playlist((age_group, mood, genres, hidden_gems_ratio)))
+        return _to_columns(songs)
+
+    preview = st.empty()
+    songs: List[Song] = []
+    try:
+        for song in _iter_async(_agent.stream_playlist(age_group, mood, genres, hidden_gems_ratio)):
+            songs.append(song)
+            preview.markdown("\n".join(f"{i}. **{s.title}** by {s.artist}" for i, s in enumerate(songs, 1)))
+    finally:
+        preview.empty()
+    return _to_columns(_rank_playlist(songs))
+
+def render_playlist(playlist: pd.DataFrame):
+    # One dataframe message instead of a row of columns per song
+    st.dataframe(
+        playlist,
+        column_config={
+            "title": "Song",
+            "artist": "Artist",
+            "genre": "Genre",
+            "popularity": st.column_config.ProgressColumn(
+                "Popularity", min_value=0, max_value=1, format="%.2f"
+            )
+        },
+        width="stretch"
+    )
 
 def main():
     st.set_page_config(page_title="AI Music Playlist Generator", page_icon="🎵")
     st.title("🎵 AI Music Playlist Generator")
     
-    agent = MusicAgent()
+    agent = _get_agent()
     
     # Add distribution explanation
     st.markdown("""
@@ -97,10 +445,10 @@ def main():
     
     with st.sidebar:
         st.header("Your Preferences")
-        age = st.number_input("Age", min_value=13, max_value=100, value=25)
-        mood = st.selectbox("Current Mood", options=agent.mood_options)
+        age = st.number_input("Age", min_value=13, max_value=MAX_AGE, value=25)
+        mood = st.selectbox("Current Mood", options=MOOD_OPTIONS)
         
-        recommended_genres = agent.genre_by_age[agent.get_age_group(age)]
+        recommended_genres = GENRE_BY_AGE[agent.get_age_group(age)]
         selected_genres = st.multiselect(
             "Select your favorite genres",
             options=recommended_genres,
@@ -114,33 +462,53 @@ def main():
     preferences = MusicPreferences(
         age=age,
         mood=mood,
-        favorite_genres=selected_genres,
+        favorite_genres=tuple(selected_genres),
         hidden_gems_ratio=hidden_gems
     )
     
+    background = st.checkbox(
+        "Background (50% cheaper)",
+        help="Queue the playlist through the OpenAI Batch API. Results can take up to 24 hours."
+    )
+    race = st.checkbox(
+        "Race gpt-4o for quality",
+        help="Ask gpt-4o-mini and gpt-4o at once and keep whichever answers first. Costs more."
+    )
+    
     if st.button("Generate Playlist"):
-        with st.spinner("Generating playlist..."):
-            playlist = agent.generate_playlist(preferences)
-        
-        if playlist:
-            st.success("Playlist generated!")
+        if background:
+            try:
+                st.session_state["batch_id"] = _run(agent.generate_playlist_batch([preferences]))
+            except Exception as e:
+                st.error(f"Error queueing playlist: {str(e)}")
+        else:
+            with st.spinner("Generating playlist..."):
+                playlist = agent.generate_playlist(preferences, race)
             
-            # Create columns for the table header
-            cols = st.columns([3, 2, 2, 1])
-            cols[0].markdown("**Song**")
-            cols[1].markdown("**Artist**")
-            cols[2].markdown("**Genre**")
-            cols[3].markdown("**Rating**")
+            if not playlist.empty:
+                st.success("Playlist generated!")
+                render_playlist(playlist)
+
+    if "batch_id" in st.session_state:
+        batch_id = st.session_state["batch_id"]
+        st.info(f"Background playlist queued (batch {batch_id}).")
+        if st.button("Check background playlist"):
+            try:
+                playlists = _run(agent.collect_playlist_batch(batch_id))
+            except Exception as e:
+                st.error(f"Error retrieving background playlist: {str(e)}")
+                del st.session_state["batch_id"]
+                return
             
-            # Display each song in the table
-            for i, song in enumerate(playlist, 1):
-                cols = st.columns([3, 2, 2, 1])
-                cols[0].write(f"{i}. {song.title}")
-                cols[1].write(song.artist)
-                cols[2].write(song.genre)
-                # Convert popularity to stars (1-5)
-                stars = "⭐" * int(round(song.popularity * 5))
-                cols[3].write(stars)
+            if playlists is None:
+                st.info("Still processing, check back later.")
+            else:
+                del st.session_state["batch_id"]
+                if not playlists[0].empty:
+                    st.success("Background playlist ready!")
+                    render_playlist(playlists[0])
+                else:
+                    st.error("The background playlist could not be generated.")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
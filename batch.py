@@ -0,0 +1,57 @@
+from openai import AsyncOpenAI
+from openai.types import Batch
+from typing import List, Dict, Any, Optional
+import msgspec
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+async def submit_batch(client: AsyncOpenAI, requests: List[Dict[str, Any]]) -> str:
+    # One JSONL line per chat completion, indexed so results can be reordered
+    lines = [
+        msgspec.json.encode({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": request
+        })
+        for i, request in enumerate(requests)
+    ]
+    batch_file = await client.files.create(
+        file=("playlists.jsonl", b"\n".join(lines)),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+        # request_counts is optional on retrieved batches, so keep our own count
+        metadata={"requests": str(len(requests))}
+    )
+    return batch.id
+
+def _request_count(batch: Batch) -> int:
+    if batch.metadata and "requests" in batch.metadata:
+        return int(batch.metadata["requests"])
+    return batch.request_counts.total if batch.request_counts else 0
+
+async def collect_batch(client: AsyncOpenAI, batch_id: str) -> Optional[List[Optional[str]]]:
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status in FAILED_STATUSES:
+        raise RuntimeError(f"Batch {batch_id} {batch.status}")
+    if batch.status != "completed":
+        return None
+
+    # Requests that errored are left as None
+    contents: List[Optional[str]] = [None] * _request_count(batch)
+    if batch.output_file_id is None:
+        return contents
+
+    output = await client.files.content(batch.output_file_id)
+    for line in output.content.splitlines():
+        result = msgspec.json.decode(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        contents[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+    return contents
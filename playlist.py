@@ -0,0 +1,134 @@
+from typing import List, Dict, Any, Tuple, Mapping, Final
+from types import MappingProxyType
+from dataclasses import dataclass, fields
+from bisect import bisect_right
+import msgspec
+import re
+import textwrap
+
+# Streamlit re-executes app.py on every rerun, but imported modules load
+# once per process, so the tables, schemas and decoders live here.
+
+@dataclass(slots=True, frozen=True)
+class MusicPreferences:
+    age: int
+    mood: str
+    favorite_genres: Tuple[str, ...]
+    hidden_gems_ratio: int  # Percentage of hidden gems (0-100)
+
+@dataclass(slots=True, frozen=True)
+class Song:
+    title: str
+    artist: str
+    genre: str
+    popularity: float
+
+SONG_FIELDS = tuple(field.name for field in fields(Song))
+
+class PlaylistResponse(msgspec.Struct):
+    songs: List[Song]
+
+class UserPlaylist(msgspec.Struct):
+    user: int
+    songs: List[Song]
+
+class MultiPlaylistResponse(msgspec.Struct):
+    playlists: List[UserPlaylist]
+
+# Decoding, validation and Song construction happen in a single pass
+PLAYLIST_DECODER = msgspec.json.Decoder(PlaylistResponse)
+MULTI_PLAYLIST_DECODER = msgspec.json.Decoder(MultiPlaylistResponse)
+SONG_DECODER = msgspec.json.Decoder(Song)
+SONG_LIST_DECODER = msgspec.json.Decoder(List[Song])
+
+MOOD_OPTIONS: Final[Tuple[str, ...]] = (
+    "Happy", "Energetic", "Relaxed", "Melancholic",
+    "Focused", "Romantic", "Party", "Chill"
+)
+
+# Lower bound of every age group after the first
+AGE_BOUNDS: Final[Tuple[int, ...]] = (18, 25, 35, 45)
+AGE_LABELS: Final[Tuple[str, ...]] = ("13-17", "18-24", "25-34", "35-44", "45+")
+# Group index for every age up to MAX_AGE, so lookups are a single byte read
+MAX_AGE = 100
+AGE_LUT: Final[bytes] = bytes(bisect_right(AGE_BOUNDS, age) for age in range(MAX_AGE + 1))
+
+GENRE_BY_AGE: Final[Mapping[str, Tuple[str, ...]]] = MappingProxyType({
+    "13-17": ("Pop", "Hip Hop", "K-pop", "Alternative", "Indie"),
+    "18-24": ("Pop", "Hip Hop", "R&B", "Alternative", "Electronic"),
+    "25-34": ("Pop", "Rock", "Hip Hop", "R&B", "Electronic"),
+    "35-44": ("Rock", "Pop", "Alternative", "Country", "Jazz"),
+    "45+": ("Classic Rock", "Jazz", "Classical", "Country", "Folk")
+})
+
+PLAYLIST_SIZE = 25
+
+SYSTEM_PROMPT = (
+    "You are a music expert who builds playlists. First brainstorm twice as many "
+    "candidates silently, then output only the best ones."
+)
+# Shared by every request, so it must never be mutated. A plain dict because
+# the request bodies are serialized as JSON.
+SYSTEM_MESSAGE: Final[Dict[str, str]] = {"role": "system", "content": SYSTEM_PROMPT}
+
+PROMPT_TEMPLATE = textwrap.dedent("""\
+    Generate a playlist of {size} songs for:
+    Age group: {age_group}, Mood: {mood}
+    Genres: {genres}
+    Distribution: {hidden_gems_ratio}% hidden gems (popularity 0.1-0.4) and {popular_ratio}% popular songs (popularity 0.7-1.0)""")
+
+def playlist_schema(size: int) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {
+            "songs": {
+                "type": "array",
+                "minItems": size,
+                "maxItems": size,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "artist": {"type": "string"},
+                        "genre": {"type": "string"},
+                        "popularity": {"type": "number", "minimum": 0, "maximum": 1}
+                    },
+                    "required": ["title", "artist", "genre", "popularity"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["songs"],
+        "additionalProperties": False
+    }
+
+PLAYLIST_SCHEMA = playlist_schema(PLAYLIST_SIZE)
+
+def multi_playlist_schema(users: int) -> Dict[str, Any]:
+    # Exactly one block per user, in order, so blocks map to callers by position
+    return {
+        "type": "object",
+        "properties": {
+            "playlists": {
+                "type": "array",
+                "minItems": users,
+                "maxItems": users,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "user": {"type": "integer", "enum": list(range(1, users + 1))},
+                        "songs": PLAYLIST_SCHEMA["properties"]["songs"]
+                    },
+                    "required": ["user", "songs"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["playlists"],
+        "additionalProperties": False
+    }
+
+# A complete song object. Structured outputs keep the schema's key order, so
+# anchoring on "title" can't match a brace inside a string; quoted values may
+# still contain braces.
+SONG_OBJECT_RE = re.compile(rb'\{\s*"title"(?:[^{}"]|"(?:[^"\\]|\\.)*")*\}')
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# app.py is a script rather than a package, so import it from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,244 @@
+import asyncio
+from types import SimpleNamespace
+
+import msgspec
+import pytest
+
+import app
+from playlist import Song
+
+KEY_POP = ("18-24", "Happy", ("Pop",), 30)
+KEY_ROCK = ("25-34", "Chill", ("Rock",), 50)
+
+def _songs(genre, count=3):
+    return [Song(f"{genre} {i}", f"Artist {i}", genre, i / 10) for i in range(count)]
+
+def _response(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+class StubCompletions:
+    def __init__(self, content):
+        self.content = content
+        self.calls = []
+
+    async def create(self, **request):
+        self.calls.append(request)
+        return _response(self.content)
+
+class StubDiskCache(dict):
+    def set(self, key, value, expire=None):
+        self[key] = value
+
+@pytest.fixture
+def make_agent(monkeypatch):
+    def make(content="{}"):
+        completions = StubCompletions(content)
+        monkeypatch.setattr(app, "_get_openai", lambda: SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+        monkeypatch.setattr(app, "_get_disk_cache", StubDiskCache)
+        monkeypatch.setattr(app.st, "secrets", {})
+        return app.MusicAgent(), completions
+    return make
+
+class StubAgent:
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    async def fetch_playlists(self, keys):
+        self.calls.append(list(keys))
+        if isinstance(self.results, Exception):
+            raise self.results
+        return [self.results[key] for key in keys]
+
+async def _stream(items, delay=0.0, error=None):
+    for item in items:
+        await asyncio.sleep(delay)
+        yield item
+    if error is not None:
+        raise error
+
+def test_coalescer_merges_concurrent_requests():
+    agent = StubAgent({KEY_POP: _songs("Pop"), KEY_ROCK: _songs("Rock")})
+
+    async def run():
+        coalescer = app.PlaylistCoalescer(agent)
+        return await asyncio.gather(coalescer.submit(KEY_POP), coalescer.submit(KEY_ROCK))
+
+    pop, rock = asyncio.run(run())
+    assert agent.calls == [[KEY_POP, KEY_ROCK]]
+    assert pop == _songs("Pop")
+    assert rock == _songs("Rock")
+
+def test_coalescer_caps_requests_per_completion(monkeypatch):
+    monkeypatch.setattr(app, "COALESCE_MAX_REQUESTS", 2)
+    keys = [("18-24", "Happy", ("Pop",), ratio) for ratio in range(5)]
+    agent = StubAgent({key: _songs("Pop") for key in keys})
+
+    async def run():
+        coalescer = app.PlaylistCoalescer(agent)
+        return await asyncio.gather(*(coalescer.submit(key) for key in keys))
+
+    asyncio.run(run())
+    assert [len(call) for call in agent.calls] == [2, 2, 1]
+
+def test_coalescer_propagates_errors_to_every_caller():
+    agent = StubAgent(RuntimeError("boom"))
+
+    async def run():
+        coalescer = app.PlaylistCoalescer(agent)
+        return await asyncio.gather(
+            coalescer.submit(KEY_POP), coalescer.submit(KEY_ROCK), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert [str(result) for result in results] == ["boom", "boom"]
+
+def test_coalescer_rejects_missing_playlists():
+    agent = StubAgent({KEY_POP: _songs("Pop"), KEY_ROCK: None})
+
+    async def run():
+        coalescer = app.PlaylistCoalescer(agent)
+        return await asyncio.gather(
+            coalescer.submit(KEY_POP), coalescer.submit(KEY_ROCK), return_exceptions=True
+        )
+
+    pop, rock = asyncio.run(run())
+    assert pop == _songs("Pop")
+    assert isinstance(rock, RuntimeError)
+
+def test_fetch_playlists_maps_blocks_by_position(make_agent):
+    # The user labels are wrong, but blocks still follow the prompt order
+    content = msgspec.json.encode({"playlists": [
+        {"user": 2, "songs": _songs("Pop")},
+        {"user": 2, "songs": _songs("Rock")},
+    ]})
+    agent, completions = make_agent(content)
+    pop, rock = asyncio.run(agent.fetch_playlists([KEY_POP, KEY_ROCK]))
+    assert {song.genre for song in pop} == {"Pop"}
+    assert {song.genre for song in rock} == {"Rock"}
+
+    playlists = completions.calls[0]["response_format"]["json_schema"]["schema"]["properties"]["playlists"]
+    assert playlists["minItems"] == playlists["maxItems"] == 2
+    assert playlists["items"]["properties"]["user"]["enum"] == [1, 2]
+
+def test_coalesced_playlist_uses_disk_cache(make_agent):
+    content = msgspec.json.encode({"playlists": [{"user": 1, "songs": _songs("Pop")}]})
+    agent, completions = make_agent(content)
+
+    async def run():
+        first = await agent.coalesced_playlist(KEY_POP)
+        second = await agent.coalesced_playlist(KEY_POP)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert len(completions.calls) == 1
+
+def test_merge_streams_yields_in_arrival_order():
+    async def run():
+        merged = app._merge_streams([_stream("ac", delay=0.02), _stream("b", delay=0.03)])
+        return [item async for item in merged]
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+def test_merge_streams_raises_and_cancels_other_streams():
+    cancelled = asyncio.Event()
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+            yield "never"
+        finally:
+            cancelled.set()
+
+    async def run():
+        items = []
+        with pytest.raises(ValueError):
+            async for item in app._merge_streams([_stream("a", error=ValueError("bad")), slow()]):
+                items.append(item)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return items
+
+    assert asyncio.run(run()) == ["a"]
+
+def _chunk(content, finish_reason=None):
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+class StubStreamingCompletions(StubCompletions):
+    def __init__(self, chunks):
+        super().__init__(None)
+        self.chunks = chunks
+
+    async def create(self, **request):
+        self.calls.append(request)
+
+        async def stream():
+            for chunk in self.chunks:
+                yield chunk
+        return stream()
+
+def test_stream_request_raises_on_truncated_completion(make_agent):
+    agent, _ = make_agent()
+    song = msgspec.json.encode(_songs("Pop", 1)[0]).decode()
+    agent.client.chat.completions = StubStreamingCompletions([
+        _chunk('{"songs": [' + song + ','),
+        _chunk('{"title": "Cut', finish_reason="length"),
+    ])
+    request = agent._build_request(*KEY_POP)
+
+    async def run():
+        songs = []
+        with pytest.raises(RuntimeError, match="length"):
+            async for item in agent._stream_request(request):
+                songs.append(item)
+        return songs
+
+    assert asyncio.run(run()) == _songs("Pop", 1)
+    assert not agent.disk_cache
+
+class StubGenreCompletions(StubCompletions):
+    # Streams a complete playlist of the requested size and genre
+    def __init__(self):
+        super().__init__(None)
+
+    async def create(self, **request):
+        self.calls.append(request)
+        size = request["response_format"]["json_schema"]["schema"]["properties"]["songs"]["minItems"]
+        genre = request["messages"][1]["content"].split("Genres: ")[1].split("\n")[0]
+        content = msgspec.json.encode({"songs": _songs(genre, size)}).decode()
+
+        async def stream():
+            for i in range(0, len(content), 40):
+                yield _chunk(content[i:i + 40])
+            yield _chunk(None, finish_reason="stop")
+        return stream()
+
+@pytest.mark.parametrize("genres, sizes", [
+    (("Pop",), [25]),
+    (("Pop", "Rock"), [13, 12]),
+    (("Jazz", "Pop", "Rock"), [9, 8, 8]),
+    (("Country", "Jazz", "Pop", "Rock"), [7, 6, 6, 6]),
+    (("Country", "Folk", "Jazz", "Pop", "Rock"), [5, 5, 5, 5, 5]),
+])
+def test_stream_playlist_splits_sizes_per_genre(make_agent, genres, sizes):
+    agent, _ = make_agent()
+    completions = agent.client.chat.completions = StubGenreCompletions()
+
+    async def run():
+        return [song async for song in agent.stream_playlist("18-24", "Happy", genres, 30)]
+
+    songs = asyncio.run(run())
+    requested = {
+        call["messages"][1]["content"].split("Genres: ")[1].split("\n")[0]:
+            call["response_format"]["json_schema"]["schema"]["properties"]["songs"]["minItems"]
+        for call in completions.calls
+    }
+    assert requested == dict(zip(genres, sizes))
+    assert len(songs) == sum(sizes) == app.PLAYLIST_SIZE
+
+    # Each genre's request is cached under its own key, so a rerun makes no calls
+    requests = [{k: v for k, v in call.items() if k != "stream"} for call in completions.calls]
+    assert set(agent.disk_cache) == {app._cache_key(request) for request in requests}
+    asyncio.run(run())
+    assert len(completions.calls) == len(genres)